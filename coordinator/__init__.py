@@ -2,4 +2,5 @@
 from .sources import Source
 from .steps import Step
 from .graphs import Graph
+from .plans import Plan
 from .coordinator import Coordinator
\ No newline at end of file
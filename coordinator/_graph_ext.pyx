@@ -0,0 +1,92 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+""" Optional compiled graph routines
+
+Graph works without this module; if it has been built, eg with
+
+    cythonize -i coordinator/_graph_ext.pyx
+
+Graph.scc() uses it for the Tarjan inner loop.
+"""
+
+from libc.stdlib cimport malloc, free
+
+def _scc_c(int[::1] indptr, int[::1] indices, Py_ssize_t n):
+    """ Tarjan's SCCs over a CSR graph with n nodes (see Graph.scc)
+
+    Same (iterative) traversal as the pure Python version, over C arrays,
+    so it finds the same components in the same order.
+
+    Returns components, as lists of node ids
+    """
+
+    cdef int *low  = <int *> malloc(n * sizeof(int))
+    cdef int *disc = <int *> malloc(n * sizeof(int))
+    cdef int *nxt  = <int *> malloc(n * sizeof(int))
+    cdef int *st   = <int *> malloc(n * sizeof(int))
+    cdef int *work = <int *> malloc(n * sizeof(int))
+    cdef char *mem = <char *> malloc(n * sizeof(char))
+
+    cdef Py_ssize_t r
+    cdef int t = 0, sp = 0, wp = 0, u, v, w, p
+    cdef list cc = [], comp
+
+    if n > 0 and (low == NULL or disc == NULL or nxt == NULL
+                    or st == NULL or work == NULL or mem == NULL):
+        free(low); free(disc); free(nxt); free(st); free(work); free(mem)
+        raise MemoryError()
+
+    try:
+
+        for r in range(n):
+            low[r], disc[r], nxt[r], mem[r] = -1, -1, indptr[r], 0
+
+        for r in range(n):
+
+            if disc[r] >= 0:
+                continue
+
+            # start a DFS at r
+            disc[r], low[r], mem[r] = t, t, 1
+            st[sp] = r; sp += 1
+            t += 1
+            work[0] = r; wp = 1
+
+            while wp > 0:
+
+                u = work[wp-1]
+
+                if nxt[u] < indptr[u+1]:
+
+                    v = indices[nxt[u]]
+                    nxt[u] += 1
+
+                    if disc[v] < 0:
+                        disc[v], low[v], mem[v] = t, t, 1
+                        st[sp] = v; sp += 1
+                        t += 1
+                        work[wp] = v; wp += 1
+
+                    elif mem[v] and disc[v] < low[u]:
+                        low[u] = disc[v]
+
+                    continue
+
+                wp -= 1
+                if wp > 0:
+                    p = work[wp-1]
+                    if low[u] < low[p]:
+                        low[p] = low[u]
+
+                if low[u] == disc[u]:
+                    w, comp = -1, []
+                    while w != u:
+                        sp -= 1
+                        w = st[sp]
+                        comp.append(w)
+                        mem[w] = 0
+                    cc.append(comp)
+
+    finally:
+        free(low); free(disc); free(nxt); free(st); free(work); free(mem)
+
+    return cc
@@ -1,14 +1,16 @@
 
 import logging
 
-from typing import Any, List, Dict, Optional, Union, Callable
+from collections import deque
+from typing import Any, List, Dict, Iterable, Optional, Union, Callable
 from types import SimpleNamespace
 
-from asyncio import Task, create_task, sleep as asleep
+from asyncio import Future, Queue, FIRST_COMPLETED, create_task, gather, get_running_loop, wait
 
 from coordinator.steps import Step
 from coordinator.graphs import Graph
 from coordinator.sources import Source
+from coordinator.plans import Plan
 
 class Coordinator: 
 
@@ -16,34 +18,58 @@ class Coordinator:
 
         # load config from YAML/JSON if str, dict o/w
         
-        self.sleep_time = 0.0
+        # re-check the step graph for cycles in verify; add already 
+        # rejects steps that would close a cycle
+        self.debug = False
 
         # DAG always has a "_source" vertex for run-level input
         self._dag = Graph(nodes=['_source'])
 
         self._steps = {}
         self._verified = False
+        self._verified_params = frozenset() # param keys verify last checked
+
+        # cached step graph properties, invalidated in add/remove
+        self._leaves_cache = None
+        self._intermediates_cache = None
+        self._step_ns = None
+
+        # execution plan, built in verify and driven by run
+        self._plan = None
 
     def _configure(self, config: dict={}):
         pass
 
+    def _invalidate(self):
+        """ (Internal) Reset cached state after the step set changes """
+        self._verified = False
+        self._plan = None
+        self._leaves_cache = None
+        self._intermediates_cache = None
+        self._step_ns = None
+
     def __repr__(self):
         return "Coordinator[" + ', '.join([s for s in self._steps]) + "]"
 
-    def __getattr__(self, attr):
-        if attr == "step": 
-            return SimpleNamespace(**self._steps)
-        raise AttributeError(f"{self.__class__.__name__} has no attribute \"{attr}\"")
+    @property
+    def step(self) -> SimpleNamespace:
+        """ steps as attributes, eg C.step.name; rebuilt only after add/remove """
+        if self._step_ns is None:
+            self._step_ns = SimpleNamespace(**self._steps)
+        return self._step_ns
 
     def dag(self):
         return self._dag
 
-    def add(self, step: Union[Step,Dict[str,Any]]):
-        """Add a step, by Step obj or by dict to initialize Step with. Chainable. """
+    def plan(self) -> Optional[Plan]:
+        return self._plan
+
+    def _validate(self, step: Union[Step,Dict[str,Any]]) -> Step:
+        """ (Internal) Validate a step to add, by Step obj or by dict """
 
         # assert call with proper Step type
         if isinstance(step, dict):
-            return self.__add__(Step(**step))
+            step = Step(**step)
 
         # validate input type
         if not isinstance(step, Step):
@@ -53,16 +79,84 @@ class Coordinator:
         if step.name in self._steps:
             raise ValueError(f"Steps must have unique names, and there is already a step {step.name}")
 
+        return step
+
+    def _rollback(self, steps: List[Step], new: List[str]) -> None:
+        """ (Internal) Undo adding steps, and the DAG nodes new with them """
+        for step in steps:
+            for dp in step.depends_on:
+                self._dag.remove(dp, step.name)
+            self._steps.pop(step.name)
+        for n in new:
+            self._dag.remove(n)
+
+    def add(self, step: Union[Step,Dict[str,Any]]):
+        """Add a step, by Step obj or by dict to initialize Step with. Chainable. """
+
+        step = self._validate(step)
+
         # add step after validations
         self._steps[step.name] = step
 
-        # add edges to DAG we use for cycle analysis
+        # add the step (even one with no dependencies) and its edges to 
+        # the DAG we use for cycle analysis and scheduling, noting any 
+        # nodes that are new so we can roll back
+        new = [n for n in {step.name, *step.depends_on} if n not in self._dag]
+        self._dag.add(step.name)
         for dp in step.depends_on:
             self._dag.add(dp, step.name)
 
+        # the DAG detects cycles incrementally as edges are added, so we 
+        # can reject a step that would close a cycle right here
+        if self._dag.cyclic():
+            self._rollback([step], new)
+            raise ValueError(f"Adding step {step.name} would make the step graph cyclic")
+
+        self._invalidate()
+
+        # return self for chaining
+        return self
+
+    def add_many(self, steps: Iterable[Union[Step,Dict[str,Any]]]):
+        """ Add several steps, by Step objs or dicts, at once. Chainable. 
+
+        Like add, but the DAG edges for all the steps are inserted as one
+        batch and checked for cycles once, and cached state is reset once. 
+        Either all of the steps are added, or (on error) none of them. 
+        """
+
+        added, edges = [], []
+        try:
+            for step in steps:
+                step = self._validate(step)
+                self._steps[step.name] = step
+                added.append(step)
+                edges.extend((dp, step.name) for dp in step.depends_on)
+        except Exception:
+            for step in added:
+                self._steps.pop(step.name)
+            raise
+
+        # add all the steps (even ones with no dependencies) and edges in 
+        # one go, noting any nodes that are new
+        names = [s.name for s in added]
+        new = [n for n in {*names, *(n for e in edges for n in e)} if n not in self._dag]
+        self._dag.bulk_load(nodes=names, edges=edges)
+
+        if self._dag.cyclic():
+            self._rollback(added, new)
+            names = '", "'.join(names)
+            raise ValueError(f"Adding steps \"{names}\" would make the step graph cyclic")
+
+        self._invalidate()
+
         # return self for chaining
         return self
 
+    def extend(self, steps: Iterable[Union[Step,Dict[str,Any]]]):
+        """ wraps add_many (like list.extend) """
+        return self.add_many(steps)
+
     def remove(self, step: Union[Step,str]):
         """ Remove a step, by Step obj or by name. Chainable. """
 
@@ -70,13 +164,16 @@ class Coordinator:
         if isinstance(step, Step):
             return self.__sub__(step.name)
 
-        # if this name is a step name, remove the step
+        # if this name is a step name, remove the step (and any
+        # results it has cached)
         if step in self:
-            self._steps.pop(step)
+            self._steps.pop(step).clear_cache()
 
         # remove from the DAG
         self._dag.remove(step)
 
+        self._invalidate()
+
         # return self for chaining
         return self
 
@@ -97,17 +194,21 @@ class Coordinator:
         that are _not_ defined in the step list. This would mean a step
         has been added that depends on another step that has _not_ been 
         added (yet). 
+
+        The result is cached (as a frozenset) until steps are added or 
+        removed. 
         """
 
         # take the union of all dependencies 
-        v = set({})
-        for s in self._steps:
-            v = v | set(list(self._steps[s].depends_on.keys()))
-        v.remove('_source')
+        if self._intermediates_cache is None:
+            v = set().union(*(step.depends_on.keys() for step in self._steps.values()))
+            v.discard('_source')
+            self._intermediates_cache = frozenset(v)
+        v = self._intermediates_cache
         if verify: 
-            defined_keys = v & set(list(self._steps.keys()))
-            if len(defined_keys) < len(v):
-                undefined_keys = '", "'.join([s for s in v if s not in self._steps])
+            undefined_keys = v - self._steps.keys()
+            if undefined_keys:
+                undefined_keys = '", "'.join(undefined_keys)
                 raise ValueError(f"There are undefined dependency steps: \"{undefined_keys}\"")
         return v
 
@@ -124,8 +225,13 @@ class Coordinator:
         
         Leaves are steps that don't feed any other steps, ie not intermediates.
         In other words, terminal or "sink" nodes (if steps are nodes). 
+
+        The result is cached (as a frozenset) until steps are added or 
+        removed. 
         """
-        return self._dag.leaves()
+        if self._leaves_cache is None:
+            self._leaves_cache = frozenset(self._dag.leaves())
+        return self._leaves_cache
 
     def verified(self):
         return self._verified
@@ -140,65 +246,89 @@ class Coordinator:
         would not be runnable as step "2" is not defined. Our add/remove
         syntax should eliminate this possibility though. 
 
-        Check that the step graph is not cyclic, which would
-        represent a loop not a tree. eg
+        The step graph can't be cyclic, which would represent a loop 
+        not a tree. eg
 
             N=[0,1], E=[(0->1),(1->0)]
 
         would not be runnable because it would just cycle (and our
-        dependency logic would probably fail). 
+        dependency logic would probably fail). add rejects such steps
+        as they are added, but with debug == True we check again here. 
 
         If we have parameters, check that there are no naming conflicts
         between parameters and arguments from dependencies. 
+
+        Finally, build the execution Plan used by run: a topological 
+        order of the steps, how many dependencies each step waits on, 
+        which steps depend on each step, kwarg builders for each step
+        and the leaf steps. The Plan is only rebuilt after steps change, 
+        not when run re-verifies for different parameter keys. 
         """
 
         # check for undefined dependencies
         self.intermediates(verify=True)
 
-        # check for cycles
-        if self._dag.cyclic():
+        # check for cycles (defensively; add should prevent them)
+        if self.debug and self._dag.cyclic():
             raise ValueError("The implied step graph is cyclic, not executable")
 
         # check parameters if passed
         if params: 
-            ambiguous_keys = set(list(params.keys())) & set(list(self._steps.keys()))
-            if len(ambiguous_keys) > 0:
+            ambiguous_keys = params.keys() & self._steps.keys()
+            if ambiguous_keys:
                 ambiguous_keys = '\", \"'.join(ambiguous_keys)
                 raise ValueError(f"There are ambiguous data/parameter keys: \"{ambiguous_keys}\"")
 
+        # compute the execution plan once, rather than reinterpreting
+        # steps and their dependencies while running; it doesn't depend
+        # on params, so we keep it until steps are added or removed
+        if self._plan is None:
+            self._plan = Plan(self._steps, self._dag)
+
         # if no failures, return 
         self._verified = True
+        self._verified_params = frozenset(params or ())
 
         # return True, as verification passed, but really raise if not
         return True
 
     def launch(self, step: Union[Step,str], source: Any, 
-                    data: Dict[str,Any], params: Dict[str,Any]) -> Task:
-        """ "Launch" a step, meaning run the step if possible
-        
-        First, we check if data has fields for each prerequisite for the 
-        step. These fields should be populated if those other steps are
-        complete (or we know their output). 
-
-        We then construct kwargs to pass to the Step executor. 
-
-        Finally an asyncio.Task is created for this execution. 
-        """
+                    data: Dict[str,Any], params: Dict[str,Any]) -> Optional[Future]:
+        """ "Launch" a step, by Step obj or by name; see _launch_step """
 
         # assert call is with a step, not a step name
         if isinstance(step, str):
             if step not in self._steps:
                 raise ValueError(f"Cannot launch step {step} here, no definition")
-            return self.launch(self._steps[step], source=source, data=results, params=params)
+            step = self._steps[step]
 
         # now that we've asserted a call with a Step type, enforce that
         if not isinstance(step, Step):
             raise ValueError(f"Cannot launch non-Step type {type(step)}")
 
+        return self._launch_step(step, source=source, data=data, params=params)
+
+    def _launch_step(self, step: Step, source: Any, 
+                    data: Dict[str,Any], params: Dict[str,Any]) -> Optional[Future]:
+        """ (Internal) "Launch" a step, meaning run the step if possible
+        
+        First, we check if data has fields for each prerequisite for the 
+        step. These fields should be populated if those other steps are
+        complete (or we know their output). 
+
+        We then construct kwargs to pass to the Step executor. 
+
+        If the step caches results and has a cached result for these 
+        kwargs, we return an already completed Future with that result. 
+        Non-async executors are called right away, also returning a 
+        completed Future. Otherwise an asyncio.Task is created for this 
+        execution. 
+        """
+
         # evaluate if the Step is, in fact, launchable from given data
         # We use existence of data fields for dependencies in depends_on
         # as a sentinel; thus these (currently) can't be optional
-        for p in [s for s in step.depends_on if s != "_source"]:
+        for p in step._required:
             if p not in data: # note data[p] _can_ be None, that may be valid output
                 logging.debug(f"step {step.name} not executable, \"{p}\" has not completed")
                 return None
@@ -209,22 +339,60 @@ class Coordinator:
         # params as a special field which gets unpacked in the Step
         # execution check. depends_on provides the keys which will 
         # (cause kwargs) get mapped into argument names. So steps 
-        # have to be configured with this in mind. 
-        kwargs = {
-            step.depends_on[p]: source if p == "_source" else data[p] 
-            for p in step.depends_on if step.depends_on[p] is not None
-        }
-        kwargs.update({'_params': params})
-
-        # create and start the asyncio.Task for this step. Using an 
-        # async sleep of 0 to facilitate context switching this 
-        # probably isn't so awful; but perhaps wrapping Tasks might
-        # be more performant for explicitly non-async executors.  
-        return create_task(step.execute(**kwargs), name=step.name)
-
-    async def sleep(self) -> None:
-        """ Wrap sleep to get more flexibility; default is 0 for fast context switch """
-        await asleep(self.sleep_time)
+        # have to be configured with this in mind. The step keeps 
+        # this mapping precomputed, with the source handled apart. 
+        kwargs = {k: data[d] for d, k in step._nonsrc_deps}
+        if step._src_kwarg is not None:
+            kwargs[step._src_kwarg] = source
+        kwargs['_params'] = params
+
+        return self._start(step, kwargs)
+
+    def _start(self, step: Step, kwargs: Dict[str,Any]) -> Future:
+        """ (Internal) Start executing a step with kwargs (including _params) """
+
+        loop = get_running_loop()
+
+        # validate the executor's arguments first: the cache is keyed on 
+        # what the executor would actually get, and invalid arguments fail
+        # whether or not a result is cached
+        try:
+            args = step._arguments(kwargs)
+        except Exception as err:
+            future = loop.create_future()
+            future.set_exception(err)
+            return future
+
+        # use (or fill) the step's result cache, if it has one
+        key = step._cache_key(args) if step.cache else None
+        if key is not None:
+            hit, result = step._cache_lookup(key)
+            if hit:
+                logging.debug(f"step {step.name} result cached")
+                future = loop.create_future()
+                future.set_result(result)
+                return future
+
+        # non-async executors are just called here, with the result (or 
+        # error) wrapped in an already completed Future; a Task would 
+        # only add scheduling round trips around a blocking call anyway
+        # (unless the step asks to run in a thread)
+        if not step.is_async() and not step.threaded:
+            future = loop.create_future()
+            try:
+                result = step.func(**args)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                if key is not None:
+                    step._cache_store(key, result)
+                future.set_result(result)
+            return future
+
+        # create and start the asyncio.Task for this step
+        if key is not None:
+            return create_task(step._execute_cached(key, args), name=step.name)
+        return create_task(step._call(args), name=step.name)
 
     async def run(self, data: Any=None, params: Dict[str,Any]={}):
         """ Run a step graph with specific data and params
@@ -232,10 +400,10 @@ class Coordinator:
         First verify the current step graph state _can_ be run. 
 
         Then loop, starting tasks for Steps that can be started 
-        (all their dependencies are complete), removing tasks and
-        storing their results when they complete, incrementing a 
-        counter for how many tasks have finished and stopping when
-        this counter equals the number of steps. 
+        (all their dependencies are complete), waiting for the next 
+        task to complete, storing its result, incrementing a counter 
+        for how many tasks have finished and stopping when this 
+        counter equals the number of steps. 
 
         By default we return only step results from leaves of the 
         step graph. 
@@ -244,12 +412,14 @@ class Coordinator:
         with tools like asyncio.gather() or asyncio.Tasks. 
         """
 
-        if not self._verified: 
+        # verification holds until steps are added or removed, but the 
+        # parameter check depends on which params are passed
+        if not self._verified or params.keys() != self._verified_params: 
             self.verify(params=params)
 
         # no running tasks, completed steps, or results (yet)
-        # Note: a None result is possible, so we need results and flags
-        # (but we could also use key existence as the flag)
+        # Note: a None result is possible, so completion is tracked by 
+        # the finished/dependency counters, never by results
         # 
         # Note these run tracking datastructures are local, not class
         # variables. In principle we should be able to kick off 
@@ -260,63 +430,116 @@ class Coordinator:
         #   start time, done time, duration
         #   errors if loose exception handling
         # 
-        tasks, finished = [], 0
-        started = {self._steps[s].name: False for s in self._steps}
-        done    = {self._steps[s].name: False for s in self._steps}
-        results = {} # use result existence as a completed signal
-
-        # iterate until tasks are completed; inner loop should add tasks 
-        # when possible
-        while finished < len(self._steps):
-
-            while True: # less than timeout?
-
-                # attempt to launch unstarted tasks
-                for s in [self._steps[s] for s in done if not started[s]]:
-                    logging.debug(f"evaluating viability of step {s.name}")
-                    task = self.launch(s, source=data, data=results, params=params)
-                    if task: 
-                        logging.debug(f"started task for step {s.name}")
-                        tasks.append(task)
-                        started[s.name] = True
-
-                # see if any of the tasks have completed
-                for t in tasks: 
-                    if t.done():
-                        name = t.get_name()
-                        logging.debug(f"step {name} completed")
-                        err = t.exception()
-                        if err: 
-                            logging.error(f"step {name} had an error: {err}")
-                            raise err
-                        done[name], results[name] = True, t.result()
-                        finished += 1
-                        # tasks.remove(t) here would change the iterator
-
-                # remove completed tasks with a "not done" filter
-                tasks = [t for t in tasks if not done[t.get_name()]]
-
-                # are we finished? Note that tasks can be empty here
-                # and we can not be finished, because we need another 
-                # loop execution to know if there are more tasks to 
-                # create. 
-                if finished == len(self._steps):
-                    break
-
-                await self.sleep()
+        # drive the plan built in verify (holding on to it, in case steps
+        # change while we run); steps are referred to by their plan ids
+        plan = self._plan
+
+        finished = 0
+        results = [None] * len(plan) # by step id
+
+        # queue of (id, task) for tasks that have completed, pushed by
+        # a done callback on each task, so we never scan running tasks
+        completed = Queue()
+
+        # per-run copy of the dependency counters; a step is ready to 
+        # launch exactly when its counter hits zero
+        # (both copied from templates in the plan, not rebuilt per run)
+        pending = plan.deps_ct[:]
+        ready = deque(plan.initial)
+
+        # tasks started by this run, cancelled if we leave early (a step 
+        # failed, or the run itself was cancelled) so no steps outlive it
+        running = []
+
+        # iterate until tasks are completed: launch whatever is ready, 
+        # then block until a task completes. The event loop only wakes us
+        # when there is actual progress to record, so there is no 
+        # busy-wait over unfinished tasks. 
+        try:
+            while finished < len(plan):
+
+                # launch ready steps; steps that complete on launch (sync or 
+                # cached) are queued right away, and getting them from the 
+                # queue doesn't suspend, so a chain of them runs in one pass
+                # (the counters guarantee dependencies are complete, so we 
+                # don't check again as launch does)
+                while ready:
+                    i = ready.popleft()
+                    task = self._start(plan.steps[i], plan.kwarg_builders[i](data, results, params))
+                    logging.debug(f"started task for step {plan.topo[i]}")
+                    if task.done():
+                        completed.put_nowait((i, task))
+                    else:
+                        task.add_done_callback(lambda t, i=i: completed.put_nowait((i, t)))
+                    running.append(task)
+
+                # record the result of the next task to complete, and mark 
+                # any steps waiting only on it as ready
+                i, t = await completed.get()
+                logging.debug(f"step {plan.topo[i]} completed")
+                err = t.exception()
+                if err: 
+                    logging.error(f"step {plan.topo[i]} had an error: {err}")
+                    raise err
+                results[i] = t.result()
+                finished += 1
+                for c in plan.children[i]:
+                    pending[c] -= 1
+                    if pending[c] == 0:
+                        ready.append(c)
+
+        finally:
+            for t in running:
+                if not t.done():
+                    t.cancel()
 
         # return terminal/sink results only by default
-        return {s: results[s] for s in self.leaves()}
+        return {plan.topo[i]: results[i] for i in plan.leaves}
 
-    async def poll(self, source: Source=None, params: Dict[str,Any]={}):
+    async def poll(self, source: Source=None, params: Dict[str,Any]={}, overlap: int=1):
         """ Repeatedly run a step graph for given params
         
         Data is drawn from some Source which we expect to yield data
-        from an (async) generator. Results should also be yielded back
-        so we can use output as an async generator. 
+        from an (async) generator. Results are yielded back so we can 
+        use output as an async generator. 
+
+        Up to overlap runs are kept in flight at once, so one message's 
+        steps can proceed while the next message's are launched. Once 
+        overlap runs are in flight we wait for one to finish before 
+        drawing more data (backpressure). With overlap > 1 results are 
+        yielded in completion order, not necessarily source order. 
         """
-        async for data in source():
-            yield self.run(data=data, params=params)
+        if overlap < 1:
+            raise ValueError(f"poll overlap must be at least 1, not {overlap}")
+
+        # one loop both fills up to overlap runs while the source has 
+        # data, and drains the runs in flight once it is exhausted
+        tasks, messages = [], source().__aiter__()
+        try:
+            while True:
+                while messages is not None and len(tasks) < overlap:
+                    try:
+                        data = await messages.__anext__()
+                    except StopAsyncIteration:
+                        messages = None
+                    else:
+                        tasks.append(create_task(self.run(data=data, params=params)))
+
+                if not tasks:
+                    break
+
+                done, _ = await wait(tasks, return_when=FIRST_COMPLETED)
+                finished, tasks = [t for t in tasks if t in done], [t for t in tasks if t not in done]
+                for t in finished:
+                    yield t.result()
+
+        finally:
+            # a run failed, or the consumer stopped early (break, aclose): 
+            # don't leave other runs executing steps with nowhere to go
+            for t in tasks:
+                t.cancel()
+            if tasks:
+                await gather(*tasks, return_exceptions=True)
 
     async def __call__(self, data: Any=None, params: Dict[str,Any]={}):
         """ wraps run """
@@ -1,7 +1,14 @@
 
 from __future__ import annotations
 
-from typing import Any, List, Dict, Optional, Union, Tuple
+from array import array
+from collections import deque
+from typing import Any, Iterable, List, Dict, Optional, Union, Tuple
+
+try: # compiled SCCs, if the extension has been built
+    from coordinator._graph_ext import _scc_c
+except ImportError:
+    _scc_c = None
 
 class Graph:
 
@@ -9,9 +16,11 @@ class Graph:
     directed graph using DFS (Tarjan's Alg) O(V+E)
 
     This class represents a directed graph using a dict, 
-    with the dict keys as the node list and arrays of their
-    adjacent nodes (outgoing edges). Nodes can be any hashable
-    type. 
+    with the dict keys as the node list and (insertion ordered)
+    sets of their adjacent nodes (outgoing edges), stored as dicts
+    with None values. So edge membership, insertion and removal 
+    are all O(1), and iteration order is reproducible. Nodes can 
+    be any hashable type; repeated edges are stored once. 
 
     Methods for: 
 
@@ -24,8 +33,12 @@ class Graph:
     * removing nodes/edges
     * computing the strongly connected components
     * determining if the graph (DAG) is cyclical (has any cycles)
+    * sorting the nodes topologically
     * finding node-node paths
 
+    While the graph is acyclic a topological index of the nodes is 
+    maintained incrementally as edges are added (Pearce-Kelly), so 
+    checking for cycles is O(1) until a cycle actually forms. 
     """
 
     def __init__(
@@ -36,14 +49,28 @@ class Graph:
         self.G = {} # dictionary to store DAG
         self.cc = None
 
-        for u, v in edges:
-            self.add(u, v)
-        for v in nodes:
-            self.add(v)
+        # edge set, built on demand
+        self._edges = None
+
+        # compact (CSR) representation for traversals, built on demand
+        self._csr = None
+
+        # next hops towards each target vertex path() has been asked for
+        self._path_cache = {}
+
+        # predecessor sets (incoming edges), for backward searches
+        self._pred = {}
+
+        # topological index of each node, or None if the graph may be
+        # cyclic (and we have not recomputed an order since)
+        self._ord = {}
+        self._next = 0
+
+        self.bulk_load(nodes=nodes, edges=edges)
 
     def __repr__(self) -> str:
         """ return the graph as a string """
-        return f"{self.G}"
+        return str({u: list(self.G[u]) for u in self.G})
 
     def __contains__(self, v) -> bool:
         """ return True if v is a node """
@@ -58,28 +85,23 @@ class Graph:
 
     def nodes(self) -> set:
         """ get a set of all nodes """
-        return set(list(self.G.keys()))
-
-    def edges(self) -> set:
-        """ get a list of all edges, as node tuples """
-        ed = []
-        for u in self.G: 
-            for v in self.G[u]:
-                ed.append((u,v))
-        return set(ed)
+        return set(self.G)
+
+    def edges(self) -> frozenset:
+        """ get a set of all edges, as node tuples 
+        (cached until the graph changes, so it can't be modified) """
+        if self._edges is None:
+            self._edges = frozenset((u, v) for u, adj in self.G.items() for v in adj)
+        return self._edges
         
     def roots(self) -> set:
-        """ roots: those nodes that do not have any incoming edges """
-        rts = list(self.G.keys())
-        for u in self.G:
-            for v in self.G[u]:
-                if v in rts: 
-                    rts.remove(v)
-        return set(rts)
+        """ roots: those nodes that do not have any incoming edges 
+        (we keep predecessor lists, so this is a single pass O(V)) """
+        return {v for v, pred in self._pred.items() if not pred}
 
     def leaves(self) -> set:
         """ leaves: those nodes that do not have any outgoing edges """
-        return set([v for v in self.G if len(self.G[v]) == 0])
+        return {v for v, adj in self.G.items() if not adj}
 
     def intermediates(self) -> set:
         """ intermediates: not roots and not leaves 
@@ -87,12 +109,11 @@ class Graph:
         (a) some edge ends at v
         (b) some edge starts at v
         """
-        s = set({})
-        for v in self.G:
-            if len(self.G[v]) > 0: 
-                s = s | {v} # some edge starts at v
-                for u in self.G[v]:
-                    s = s | {u} # some edge ends at u
+        s = set()
+        for v, adj in self.G.items():
+            if adj: 
+                s.add(v) # some edge starts at v
+                s.update(adj) # some edge ends at each of adj
         return s
 
     def reverse(self) -> Graph:
@@ -107,111 +128,196 @@ class Graph:
         if u is None:
             return self
 
-        # invalidate SCCs
-        self.cc = None
+        # invalidate SCCs and other cached structure
+        self._invalidate()
 
         if u not in self.G:
-            self.G[u] = []
+            self._add_node(u)
 
         if v is not None: 
             if v not in self.G:
-                self.G[v] = []
-            self.G[u].append(v)
+                self._add_node(v)
+            if v in self.G[u]: # already an edge
+                return self
+            self.G[u][v] = None
+            self._pred[v][u] = None
+            if self._ord is not None:
+                self._reorder(u, v)
 
         return self
 
+    def add_edges(self, edges: Iterable[Tuple[Any,Any]]) -> Graph:
+        """ add many edges at once; chainable """
+        return self.bulk_load(edges=edges)
+
+    def bulk_load(
+        self, 
+        nodes: Iterable[Any]=(), 
+        edges: Iterable[Tuple[Any,Any]]=(),
+    ) -> Graph:
+        """ add many edges, then nodes, at once; chainable
+
+        Cached structure is dropped once, and rather than maintaining the
+        topological index edge by edge we recompute it (or find the graph 
+        is cyclic) once, after adding everything. 
+        """
+
+        # invalidate SCCs and other cached structure
+        self._invalidate()
+
+        # same rules for None as add: no node u, or just the node u
+        for u, v in edges:
+            if u is None:
+                continue
+            if u not in self.G:
+                self._add_node(u)
+            if v is None:
+                continue
+            if v not in self.G:
+                self._add_node(v)
+            self.G[u][v] = None
+            self._pred[v][u] = None
+
+        for v in nodes:
+            if v is not None and v not in self.G:
+                self._add_node(v)
+
+        self._reindex()
+        return self
+
+    def _invalidate(self) -> None:
+        """ (Internal) drop cached structure after nodes/edges change """
+        self.cc = None
+        self._edges = None
+        self._csr = None
+        self._path_cache = {}
+
+    def _freeze(self) -> Tuple[List[Any],Dict[Any,int],array,array]:
+        """ (Internal) Compact, integer indexed (CSR) form of the graph
+
+        Nodes get integer ids (their position in nodes); the adjacent 
+        nodes of node i are indices[indptr[i]:indptr[i+1]]. Traversals 
+        over this are integer array reads instead of dict lookups on 
+        arbitrary node objects. Cached until nodes/edges change. 
+
+        Returns (nodes, index, indptr, indices)
+        """
+        if self._csr is None:
+            nodes = list(self.G)
+            index = {u: i for i, u in enumerate(nodes)}
+            indptr, indices = array('i', [0]), array('i')
+            for u in nodes:
+                indices.extend(index[v] for v in self.G[u])
+                indptr.append(len(indices))
+            self._csr = (nodes, index, indptr, indices)
+        return self._csr
+
+    def _add_node(self, u: Any) -> None:
+        """ (Internal) add a new node, last in the topological order """
+        self.G[u], self._pred[u] = {}, {}
+        if self._ord is not None:
+            self._ord[u] = self._next
+        self._next += 1
+
+    def _reindex(self) -> None:
+        """ (Internal) Recompute the topological index from scratch, O(V+E) """
+        order = self.topological()
+        self._ord = None if order is None else {u: i for i, u in enumerate(order)}
+        self._next = len(self.G)
+
+    def _reorder(self, u: Any, v: Any) -> None:
+        """ (Internal) Maintain the topological index for a new edge (u,v)
+
+        Pearce-Kelly dynamic topological sort: if v already comes after u
+        there is nothing to do. Otherwise we search forward from v and 
+        backward from u, but only over nodes whose index lies between 
+        the two; reaching u from v means the edge closed a cycle, in 
+        which case we stop maintaining the index. If not, the two sets 
+        of nodes found swap places within the indices they occupy. 
+        """
+
+        lb, ub = self._ord[v], self._ord[u]
+        if lb > ub:
+            return
+
+        # forward search from v, bounded above by u's index
+        fwd, seen, st = [], {v}, [v]
+        while st:
+            x = st.pop()
+            fwd.append(x)
+            for w in self.G[x]:
+                if w == u: # cycle
+                    self._ord = None
+                    return
+                if w not in seen and self._ord[w] < ub:
+                    seen.add(w)
+                    st.append(w)
+
+        # backward search from u, bounded below by v's index
+        bwd, seen, st = [], {u}, [u]
+        while st:
+            x = st.pop()
+            bwd.append(x)
+            for w in self._pred[x]:
+                if w not in seen and self._ord[w] > lb:
+                    seen.add(w)
+                    st.append(w)
+
+        # u and its ancestors take the lowest of the affected indices, 
+        # v and its descendants the highest, each in their prior order
+        fwd.sort(key=self._ord.get)
+        bwd.sort(key=self._ord.get)
+        idx = sorted(self._ord[x] for x in bwd + fwd)
+        for x, i in zip(bwd + fwd, idx):
+            self._ord[x] = i
+
     def remove(self, u: Any, v: Optional[Any]=None) -> Graph:
         """ remove a node or an edge; chainable """
 
         if u not in self.G: # bad op
             return self
 
-        # invalidate SCCs
-        self.cc = None
+        # invalidate SCCs and other cached structure
+        self._invalidate()
+
+        # removals can't create cycles, so any topological index 
+        # we are maintaining stays valid
 
         if v is not None: # remove edge (u,v)
             if v in self.G[u]:
-                self.G[u].remove(v)
+                del self.G[u][v], self._pred[v][u]
         else: # no v supplied, remove all of u
-            del self.G[u]
-            for w in self.G:
-                if u in self.G[w]:
-                    self.G[w].remove(u)
+            for w in self._pred[u]:
+                self.G[w].pop(u, None)
+            for w in self.G[u]:
+                self._pred[w].pop(u, None)
+            del self.G[u], self._pred[u]
+            if self._ord is not None:
+                del self._ord[u]
 
         return self
 
-    def _scc(
-        self, 
-        u: Any, 
-        low: Dict[Any,int], 
-        disc: Dict[Any,int], 
-        mem: Dict[Any,bool], 
-        st: List[Any]
-    ) -> None:
-        """(Internal) Recursively find Strongly Connected Components
-
-        A recursive function that find finds and adds SCCs using DFS traversal. 
-
-        Changes object state by updating self.cc when an SCC is found. 
-        Uses self.t as an intermediate variable (but this could be passed?)
-
-        u       The vertex to be visited next
-        low     Earliest visited vertex (the vertex with minimum
-                discovery time) that can be reached from subtree
-                rooted with current vertex
-        disc    Stores discovery times of visited vertices
-        mem     array for faster check whether a node is in stack
-        st      To store all the connected ancestors (could be part of SCC)
-        """
-
-        # initialize and increment discovery time
-        disc[u], low[u], mem[u] = self.t, self.t, True
-        st.append(u)
-        self.t += 1
-
-        # Go through all vertices adjacent to current vertex
-        for v in self.G[u]:
-            
-            # If v is not visited yet, then recurse for it
-            if disc[v] < 0:
-            
-                self._scc(v, low, disc, mem, st)
-
-                # Check if the subtree rooted with v has a connection to
-                # one of the ancestors of u
-                # Case 1 (per above discussion on Disc and Low value)
-                low[u] = min(low[u], low[v])
-                        
-            elif mem[v] == True:
-
-                # Update low value of 'u' only if 'v' is still in stack
-                # (i.e. it's a back edge, not cross edge).
-                # Case 2 (per above discussion on Disc and Low value)
-                low[u] = min(low[u], disc[v])
-
-        # head node found, pop the stack and print an SCC
-        w, comp = None, [] # To store stack extracted vertices
-        if low[u] == disc[u]:
-            while w != u:
-                w = st.pop()
-                comp.append(w)
-                mem[w] = False
-            self.cc.append(comp)
-            
     def scc(self) -> List[List[Any]]:
         """ Find Strongly Connected Components (SCCs)
 
         "caches" the list of SCCs, up until nodes/edges change. 
-        
-        Initializes the following for the recursive method: 
 
-        u       The vertex to be visited next
+        Tarjan's algorithm, as an iterative DFS over the compact (CSR) 
+        form of the graph with an explicit work stack, rather than 
+        recursion; so there is no recursion limit on graph size and no 
+        function call per visited vertex. Uses (indexed by node id): 
+
+        u       The vertex being visited (top of the work stack)
         low     Earliest visited vertex (the vertex with minimum
                 discovery time) that can be reached from subtree
                 rooted with current vertex
         disc    Stores discovery times of visited vertices
         mem     array for faster check whether a node is in stack
         st      To store all the connected ancestors (could be part of SCC)
+        nxt     Position of the next adjacent vertex to visit, per vertex
+
+        If the (optional) _graph_ext extension is built, the same loop
+        runs compiled. 
         """
 
         # returned "cached" result if available (and not
@@ -219,45 +325,193 @@ class Graph:
         if self.cc is not None: 
             return self.cc
 
-        self.t, self.cc = 0, [] # discovery time and connected components
+        nodes, _, indptr, indices = self._freeze()
+        n = len(nodes)
+
+        if _scc_c is not None:
+            self.cc = [[nodes[w] for w in comp] for comp in _scc_c(indptr, indices, n)]
+            return self.cc
+
+        t, self.cc = 0, [] # discovery time and connected components
 
         # Mark all the vertices as not visited
-        # and Initialize parent and visited,
-        # and ap(articulation point) arrays
-        low  = {v: -1 for v in self.G}
-        disc = {v: -1 for v in self.G}
-        mem  = {v: False for v in self.G}
+        low  = [-1] * n
+        disc = [-1] * n
+        mem  = [False] * n
         st   = []
-        
-        # Call the recursive helper function rooting at v
-        for v in self.G:
-            if disc[v] < 0:
-                self._scc(v, low, disc, mem, st)
+        nxt  = indptr[:-1]
+
+        for r in range(n):
+
+            if disc[r] >= 0:
+                continue
+
+            # start a DFS at r
+            disc[r], low[r], mem[r] = t, t, True
+            st.append(r)
+            t += 1
+            work = [r]
+
+            while work:
+
+                u = work[-1]
+
+                if nxt[u] < indptr[u+1]:
+
+                    v = indices[nxt[u]]
+                    nxt[u] += 1
+
+                    # If v is not visited yet, then "recurse" for it
+                    if disc[v] < 0:
+                        disc[v], low[v], mem[v] = t, t, True
+                        st.append(v)
+                        t += 1
+                        work.append(v)
+
+                    elif mem[v]:
+
+                        # Update low value of 'u' only if 'v' is still in stack
+                        # (i.e. it's a back edge, not cross edge).
+                        low[u] = min(low[u], disc[v])
+
+                    continue
+
+                # all vertices adjacent to u are done: "return" to the parent, 
+                # checking if the subtree rooted with u has a connection to
+                # one of the parent's ancestors
+                work.pop()
+                if work:
+                    p = work[-1]
+                    low[p] = min(low[p], low[u])
+
+                # head node found, pop the stack and store an SCC
+                if low[u] == disc[u]:
+                    w, comp = -1, [] # To store stack extracted vertices
+                    while w != u:
+                        w = st.pop()
+                        comp.append(nodes[w])
+                        mem[w] = False
+                    self.cc.append(comp)
 
         return self.cc
 
+    def scc_dag(self) -> Tuple[List[List[Any]],List[set]]:
+        """ Condensation of the graph: the DAG of its SCCs
+
+        Component i is scc()[i]; cond_adj[i] holds the components with an
+        edge from some node of component i into them. Components that do
+        not reach each other here can be processed independently.
+
+        Returns (components, cond_adj)
+        """
+        components = self.scc()
+        comp_of = {u: i for i, comp in enumerate(components) for u in comp}
+        cond_adj = [set() for _ in components]
+        for u, adj in self.G.items():
+            cu = comp_of[u]
+            for v in adj:
+                if comp_of[v] != cu:
+                    cond_adj[cu].add(comp_of[v])
+        return components, cond_adj
+
+    def has_cycle(self) -> bool:
+        """ True if the graph has a cycle (Kahn's algorithm) O(V+E)
+
+        Nodes on (or downstream of) a cycle never drain in Kahn's 
+        algorithm, so there is no topological order. No SCC bookkeeping. 
+        """
+        return self.topological() is None
+
     def cyclic(self) -> bool:
         """ True if the graph is cyclic (has a cycle), False if otherwise 
 
-        Uses SCCs: a graph is cyclic if and only if the number of SCCs is
-        less than the number of nodes. 
+        O(1) while we are maintaining a topological index, as there can
+        be no cycle. Otherwise, if SCCs are cached, a graph is cyclic if
+        and only if the number of SCCs is less than the number of nodes 
+        (or some node has an edge to itself); if not, we try to rebuild
+        the topological index (Kahn's algorithm), which fails only if 
+        the graph is cyclic. If the graph turns out to be acyclic again 
+        (after removals), we resume maintaining the topological index. 
         """
-        self.scc()
-        return len(self.cc) < len(self.G)
+        if self._ord is not None:
+            return False
+        if self.cc is not None:
+            if len(self.cc) < len(self.G) or any(u in adj for u, adj in self.G.items()):
+                return True
+        self._reindex()
+        return self._ord is None
 
     def acyclic(self) -> bool:
         return not self.cyclic()
 
-    def path(
-        self, 
-        u: Any, 
-        v: Any, 
-        head=[],
-    ) -> Optional[List[Any]]: 
-        """ Find a path between vertices
-
-        Ad-hoc algorithm based on BFS with a prev-path check for
-        cycles. Don't know complexity but can't be more than O(|N|+|E|)
+    def topological(self) -> Optional[List[Any]]:
+        """ Sort the nodes topologically (Kahn's algorithm) O(V+E)
+
+        Every node appears after all nodes with edges into it. Returns 
+        None if the graph is cyclic, as then there is no such order. 
+        """
+        indeg = {u: len(self._pred[u]) for u in self.G}
+
+        order, q = [], deque([u for u in self.G if indeg[u] == 0])
+        while q:
+            u = q.popleft()
+            order.append(u)
+            for v in self.G[u]:
+                indeg[v] -= 1
+                if indeg[v] == 0:
+                    q.append(v)
+
+        return order if len(order) == len(self.G) else None
+
+    def levels(self) -> Optional[List[List[Any]]]:
+        """ Group the nodes by topological level O(V+E)
+
+        Roots are level 0, and every other node is one level past the 
+        deepest node with an edge into it; so nodes at the same level 
+        don't depend on each other. Returns None if the graph is cyclic. 
+        """
+        order = self.topological()
+        if order is None:
+            return None
+
+        # in topological order, every node's predecessors are leveled first
+        level, levels = {}, []
+        for v in order:
+            lv = max((level[u] + 1 for u in self._pred[v]), default=0)
+            if lv == len(levels):
+                levels.append([])
+            levels[lv].append(v)
+            level[v] = lv
+
+        return levels
+
+    def _next_hops(self, v: Any) -> Dict[Any,Any]:
+        """ (Internal) Next vertex on a shortest path to v, from each vertex
+
+        BFS from v over incoming edges, so the map holds every vertex that
+        can reach v (including v itself, if it is on a cycle). Cached per
+        v until nodes/edges change. 
+        """
+        if v not in self._path_cache:
+            nxt, q = {}, deque([v])
+            while q:
+                x = q.popleft()
+                for w in self._pred[x]:
+                    if w not in nxt:
+                        nxt[w] = x
+                        q.append(w)
+            self._path_cache[v] = nxt
+        return self._path_cache[v]
+
+    def path(self, u: Any, v: Any) -> Optional[List[Any]]: 
+        """ Find a (shortest) path between vertices
+
+        Uses a BFS from v over incoming edges, O(|N|+|E|), that gives 
+        the next hop towards v from every vertex; the path is rebuilt 
+        by following next hops from u. The BFS is cached, so later 
+        paths to the same v only cost the length of the path. v itself
+        isn't marked visited up front, so path(u, u) finds a cycle 
+        through u if there is one. 
         """
 
         if u is None or v is None: 
@@ -266,26 +520,13 @@ class Graph:
         if u not in self.G or v not in self.G:
             return None
 
-        if v in self.G[u]:
-            return [u,v]
-
-        if u in head: # we've cycled
-            return [u]
-
-        # Can we cache/memoize this? Note it depends on the full path
-        # approaching u, not just u. So caching over u alone is incorrect. 
-        # caching over the prior path might though, but we would need to
-        # know this situation could occur (which I don't think it could.)
-        bfs = {w: self.path(w, v, head=head+[u]) for w in self.G[u]}
-
-        p = None # presume no path
-        for w in self.G[u]:
-            if bfs[w] is None or len(bfs[w]) < 2:
-                del bfs[w] # necessary for a local datastructure?
-            else:
-                if len(bfs[w]) == 2:
-                    return [u] + bfs[w]
-                elif p is None or len(bfs[w]) < len(p):
-                    p = [u] + bfs[w]
-        return p # returns None when u,v disconnected in G
+        nxt = self._next_hops(v)
+        if u not in nxt:
+            return None # u,v disconnected in G
 
+        p, w = [u], nxt[u]
+        while w != v:
+            p.append(w)
+            w = nxt[w]
+        p.append(v)
+        return p
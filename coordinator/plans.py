@@ -0,0 +1,80 @@
+
+from __future__ import annotations
+
+from typing import Any, List, Dict, Tuple, Callable
+
+from coordinator.steps import Step
+from coordinator.graphs import Graph
+
+def _kwarg_builder(step: Step, index: Dict[str,int]) -> Callable[[Any,List[Any],Dict[str,Any]], Dict[str,Any]]:
+    """ Specialize building a step's executor kwargs from (source, data, params)
+
+    data holds step results by step id (see Plan). The returned closure 
+    only does the work this step needs: which results it reads (by id), 
+    and whether the source is passed (and as what), are decided here, once.
+    """
+
+    deps, src = tuple((index[d], k) for d, k in step._nonsrc_deps), step._src_kwarg
+
+    if src is None:
+        def build(source: Any, data: List[Any], params: Dict[str,Any]) -> Dict[str,Any]:
+            kwargs = {k: data[i] for i, k in deps}
+            kwargs['_params'] = params
+            return kwargs
+    else:
+        def build(source: Any, data: List[Any], params: Dict[str,Any]) -> Dict[str,Any]:
+            kwargs = {k: data[i] for i, k in deps}
+            kwargs[src] = source
+            kwargs['_params'] = params
+            return kwargs
+
+    return build
+
+class Plan:
+
+    """ Execution plans for (verified) step graphs
+
+    Everything about running a step graph that doesn't depend on the
+    data or params of a particular run, computed once so that runs (eg
+    over every message from poll) only drive it:
+
+    * steps, in a topological order of the step graph
+    * the number of (step) dependencies each step waits on
+    * the steps that depend on each step
+    * the steps that can be launched right away
+    * a kwarg builder for each step's executor
+    * the leaf steps, whose results a run returns
+
+    Steps are identified by integer ids, their position in topo, so a 
+    run tracks counters and results in lists indexed by id 
+    rather than dicts keyed by step name. index maps names to ids. 
+
+    Plans are not updated when steps change; build a new one.
+    """
+
+    def __init__(self, steps: Dict[str,Step], dag: Graph) -> Plan:
+
+        self.topo: List[str] = [s for s in dag.topological() if s in steps]
+        self.index: Dict[str,int] = {s: i for i, s in enumerate(self.topo)}
+        self.steps: List[Step] = [steps[s] for s in self.topo]
+
+        self.deps_ct: List[int] = [0] * len(self.topo)
+        children: List[List[int]] = [[] for _ in self.topo]
+        for i, step in enumerate(self.steps):
+            for dp in step.depends_on:
+                if dp != "_source":
+                    self.deps_ct[i] += 1
+                    children[self.index[dp]].append(i)
+        self.children: List[Tuple[int,...]] = [tuple(c) for c in children]
+
+        self.initial: Tuple[int,...] = tuple(i for i, ct in enumerate(self.deps_ct) if ct == 0)
+
+        self.kwarg_builders: List[Callable] = [_kwarg_builder(step, self.index) for step in self.steps]
+
+        self.leaves: Tuple[int,...] = tuple(self.index[s] for s in dag.leaves() if s in steps)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}[" + ', '.join(self.topo) + "]"
+
+    def __len__(self) -> int:
+        return len(self.topo)
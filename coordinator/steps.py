@@ -1,12 +1,41 @@
 
-from typing import Any, List, Dict, Optional, Union, Callable
+from typing import Any, List, Dict, Optional, Union, Callable, Tuple, Hashable, get_origin
 
-from pydantic import BaseModel
+from collections import OrderedDict
 
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr
+
+from asyncio import to_thread
 from inspect import iscoroutinefunction
+from types import UnionType
+
+def _allowed(t: Any) -> Tuple[bool,Tuple[type,...]]:
+    """ Compile the check for an argument annotated as t
+
+    Union/Optional annotations allow any of their arguments' types, and
+    the argument is only required if None isn't one of them. Otherwise 
+    the argument is required and must be an instance of t. Generics are
+    checked against their origin (eg list for List[int]). If we can't 
+    check with isinstance (eg Any), anything (object) is allowed. 
+
+    Returns (optional, allowed types)
+    """
+    if get_origin(t) in (Union, UnionType):
+        args = t.__args__
+        required = type(None) not in args
+    else:
+        args, required = (t,), True
+    types = tuple(get_origin(a) or a for a in args)
+    if Any in types or not all(isinstance(a, type) for a in types):
+        return (not required, (object,))
+    return (not required, types)
 
 class Step(BaseModel):
 
+    # steps are immutable: what we compute from the fields (below) would 
+    # go stale on assignment, and steps are hashed by name
+    model_config = ConfigDict(frozen=True)
+
     name: str # step name
     func: Callable[..., Any] # executable
     depends_on: Dict[str,Optional[str]] = {} # list of dependencies, step => func arg
@@ -14,70 +43,161 @@ class Step(BaseModel):
     description: Optional[str] = "" # optional description for prints/logs etc
     params: Optional[Dict[Any,Any]] = {} # optional execution parameters
 
+    cache: Optional[int] = Field(None, ge=1) # optional size of an LRU cache of results
+    cache_key: Optional[Callable[..., Hashable]] = None # optional cache key from executor arguments
+
+    threaded: bool = False # run a non-async executor in a worker thread, not on the event loop
+
+    # dependencies that must complete before launching, the kwarg (if 
+    # any) the source is passed as, and (dependency, kwarg) pairs for 
+    # the other executor kwargs; computed once from depends_on rather 
+    # than on every launch
+    _required: Tuple[str,...] = PrivateAttr(default=())
+    _src_kwarg: Optional[str] = PrivateAttr(default=None)
+    _nonsrc_deps: Tuple[Tuple[str,str],...] = PrivateAttr(default=())
+
+    # executor argument and return annotations, whether the executor is
+    # async, and checks compiled from the argument annotations: whether
+    # each argument is optional, and the types it is allowed to have
+    _intypes: Dict[str,Any] = PrivateAttr(default_factory=dict)
+    _produces: Any = PrivateAttr(default=None)
+    _is_async: bool = PrivateAttr(default=False)
+    _optional: Dict[str,bool] = PrivateAttr(default_factory=dict)
+    _types: Dict[str,Tuple[type,...]] = PrivateAttr(default_factory=dict)
+
+    # LRU cache of results, keyed on (a key from) executor kwargs
+    _cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._compile()
+
+    def _compile(self) -> None:
+        """ (Internal) compute everything derived from the fields """
+        self._required = tuple(d for d in self.depends_on if d != "_source")
+        self._src_kwarg = self.depends_on.get("_source")
+        self._nonsrc_deps = tuple(
+            (d, k) for d, k in self.depends_on.items() if d != "_source" and k is not None
+        )
+        annotations = getattr(self.func, '__annotations__', {})
+        self._intypes = {k:v for k,v in annotations.items() if k != 'return'}
+        self._produces = annotations.get('return')
+        self._is_async = iscoroutinefunction(self.func)
+        self._optional, self._types = {}, {}
+        for k, t in self._intypes.items():
+            self._optional[k], self._types[k] = _allowed(t)
+
+    def model_copy(self, *, update: Optional[Dict[str,Any]]=None, deep: bool=False) -> "Step":
+        """ copy, recomputing derived state (update can change fields) """
+        copy = super().model_copy(update=update, deep=deep)
+        copy._compile()
+        copy._cache = OrderedDict() # results may not hold for the copy
+        return copy
+
     def __repr__(self):
         return f"{self.__class__.__name__}.{self.name}[{self.func}]({','.join(self.depends_on.keys())})"
 
     def __hash__(self):
-        return self.name
+        return hash(self.name)
+
+    def __eq__(self, other):
+        # steps are identified by name (as in a Coordinator)
+        return isinstance(other, Step) and self.name == other.name
 
     def consumes(self):
-        return {k:v for k,v in self.func.__annotations__.items() if k != 'return'}
+        return dict(self._intypes)
 
     def produces(self):
-        try:
-            return self.func.__annotations__['return']
-        except KeyError:
-            return None
+        return self._produces
 
     def is_async(self):
-        return iscoroutinefunction(self.func)
+        return self._is_async
 
-    async def execute(self, **kwargs) -> Any:
+    def clear_cache(self) -> None:
+        self._cache.clear()
 
-        # how do we get argument ordering correct?
-        # evaluate dynamic strict typing on arguments
+    def _cache_key(self, args: Dict[str,Any]) -> Optional[Hashable]:
+        """ (Internal) Key for the result cache, None if args aren't hashable
 
-        # get arguments and their types (we will modify this dict)
-        intypes = self.consumes()
+        args are the (validated) executor arguments, including any params
+        the executor declares. A cache_key function gets these; by default
+        we key on them and their types, as equal values of different 
+        types (eg 1 and 1.0) hash alike. 
+        """
+        try:
+            if self.cache_key is not None:
+                key = self.cache_key(**args)
+            else:
+                key = tuple((k, type(v), v) for k, v in sorted(args.items()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _cache_lookup(self, key: Hashable) -> Tuple[bool,Any]:
+        """ (Internal) (True, result) if key is cached, (False, None) o/w """
+        if key not in self._cache:
+            return False, None
+        self._cache.move_to_end(key)
+        return True, self._cache[key]
+
+    def _cache_store(self, key: Hashable, result: Any) -> None:
+        """ (Internal) store a result in the (LRU) cache """
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache:
+            self._cache.popitem(last=False)
+
+    async def _execute_cached(self, key: Hashable, args: Dict[str,Any]) -> Any:
+        """ (Internal) execute with validated args, storing the result in the (LRU) cache """
+        result = await self._call(args)
+        self._cache_store(key, result)
+        return result
+
+    def _arguments(self, kwargs: Dict[str,Any]) -> Dict[str,Any]:
+        """ (Internal) Validate kwargs (with _params) into executor arguments """
+
+        # how do we get argument ordering correct?
+        # evaluate dynamic typing on arguments, using checks compiled 
+        # from the executor's annotations at construction
+        intypes, types = self._intypes, self._types
 
         # unpack params... but treat carefully, filtering out undeclared params
         # (we should already have checked for arg/param naming conflicts)
         _params = kwargs.pop('_params')
         kwargs.update({p: v for p, v in _params.items() if p in intypes})
 
-        # now check kwargs sent against function declaration
-        for k in kwargs:
+        # now check kwargs sent against function declaration, in one pass
+        for k, v in kwargs.items():
 
             # don't accept unknown kwargs (requires caller to be specific)
-            if k not in intypes:
+            allowed = types.get(k)
+            if allowed is None:
                 raise ValueError(f"Step {self.name}'s executor does not have a keyword argument {k}")
 
             # k in both intypes and kwargs, check types for this argument
-            # Note: intypes could be Union/Optional (is Optional ok?)
-            if hasattr(intypes[k], '__args__'):
-                # Union or Optional typing?
-                if type(kwargs[k]) not in intypes[k].__args__:
-                    raise ValueError(f"Step {self.name}'s executor requires {intypes[k]}, not {type(kwargs[k])}, for argument {k}")
-            else:
-                # strict
-                if type(kwargs[k]) is not intypes[k]:
-                    raise ValueError(f"Step {self.name}'s executor requires {intypes[k]}, not {type(kwargs[k])}, for argument {k}")
-
-            # argument is ok: exists and is typed correctly/consistently
-            # downsize intypes (for marginal efficiency)?
-            intypes.pop(k)
-
-        # ok, now check remaining input types. We've checked all kwargs matches, 
-        # so we need to validate that any **missing** kwargs are Optional.
-        for k in intypes:
-
-            # validate that we are not missing **required** arguments
-            if k not in kwargs: 
-                optional = hasattr(intypes[k], "__args__") and (type(None) in intypes[k].__args__)
-                if not optional:
+            # (a single isinstance call against the precomputed tuple)
+            if not isinstance(v, allowed):
+                raise ValueError(f"Step {self.name}'s executor requires {intypes[k]}, not {type(v)}, for argument {k}")
+
+        # ok, now validate that any **missing** kwargs are Optional; every
+        # kwarg is declared, so if all declared arguments were passed there
+        # is nothing missing (the common case) and nothing to look up
+        if len(kwargs) < len(types):
+            for k, optional in self._optional.items():
+                if not optional and k not in kwargs:
                     raise ValueError(f"Required argument \"{k}\" for {self.__class__.__name__}[\"{self.name}\"] executor missing")
 
+        return kwargs
+
+    async def execute(self, **kwargs) -> Any:
+        return await self._call(self._arguments(kwargs))
+
+    async def _call(self, args: Dict[str,Any]) -> Any:
+        """ (Internal) call the executor with (validated) args """
         if self.is_async():
-            return await self.func(**kwargs)
-        return self.func(**kwargs)
+            return await self.func(**args)
+        if self.threaded: # eg blocking I/O, that other steps can overlap
+            return await to_thread(self.func, **args)
+        return self.func(**args)
 
@@ -3,10 +3,18 @@ import aiohttp
 import asyncio
 import requests
 import pytest
+import pytest_asyncio
+import responses
+import socket
 
-from time import time
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from aiohttp.test_utils import TestServer
 
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from time import time, sleep, perf_counter
+
+from typing import Any, Dict, List, Optional
 
 from coordinator import Source, Step, Coordinator
 
@@ -16,15 +24,30 @@ def f_str_to_int(msg: str) -> int:
 def f_int_to_int(msg: int) -> int:
     return msg
 
+def f_noargs() -> int:
+    return 1
+
 def f_add(i: int, a: Optional[int]=1) -> int:
     return i + a
 
+_HTTP = requests.Session() # reuse connections across requests
+_HTTP.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def f_sync_http(msg: int) -> None:
-    return requests.get("http://google.com")
+    return _HTTP.get("http://google.com", timeout=5)
+
+async def f_aio_add(i: int, a: Optional[int]=1) -> int:
+    return i + a
+
+def f_sync_wait(w: float) -> float:
+    sleep(w)
+    return w
+
+_SESSION: Optional[aiohttp.ClientSession] = None # shared, see aio_session
 
 async def f_aio_http(msg: int) -> None:
-    async with aiohttp.ClientSession() as session:
-        response = await session.get("http://google.com")
+    async with _SESSION.get("http://google.com") as response:
+        await response.read() # release the connection back to the pool
 
 async def f_aio_wait(w: int) -> None:
     s = time()
@@ -32,47 +55,45 @@ async def f_aio_wait(w: int) -> None:
     e = time()
     return w, s, e
 
+async def f_aio_pass(x: int) -> int:
+    await asyncio.sleep(0.1)
+    return x
+
+async def f_aio_join(a: int, b: int) -> int:
+    await asyncio.sleep(0.1)
+    return a + b
+
 async def atest(msg: str, **kwargs) -> int:
     return int(msg)
 
 
-@pytest.mark.asyncio
-async def test_sum_ok(params={"a":1}):
-
-    C = Coordinator()
+@pytest.fixture(scope="session")
+def sum_coord() -> Coordinator:
+    """ a chain of 5 f_add steps, built once (runs don't change it) """
+    steps = []
     for i in range(5):
         dp = {}
         if i == 0: 
             dp['_source'] = "i"
         else:
             dp[f"t{i-1}"] = "i"
-        C += {
+        steps.append({
             'name': f"t{i}", 
             'func': f_add,
             'depends_on': dp
-        }
-    results = await C.run(0, params=params)
-    print(results)
+        })
+    return Coordinator().extend(steps)
 
 @pytest.mark.asyncio
-async def test_sum_not_ok(params={"a":"1"}):
+async def test_sum_ok(sum_coord, params={"a":1}):
+    results = await sum_coord.run(0, params=params)
+    assert results == {"t4": 5}
 
-    with pytest.raises(ValueError) as err:
+@pytest.mark.asyncio
+async def test_sum_not_ok(sum_coord, params={"a":"1"}):
 
-        C = Coordinator()
-        for i in range(5):
-            dp = {}
-            if i == 0: 
-                dp['_source'] = "i"
-            else:
-                dp[f"t{i-1}"] = "i"
-            C += {
-                'name': f"t{i}", 
-                'func': f_add,
-                'depends_on': dp
-            }
-        results = await C.run(0, params=params)
-        print(results)
+    with pytest.raises(ValueError) as err:
+        await sum_coord.run(0, params=params)
 
 @pytest.mark.asyncio
 async def test_types():
@@ -94,7 +115,7 @@ async def test_types():
     }
 
     results = await C.run("0")
-    print(results)
+    assert results == {"ti": 0}
 
 @pytest.mark.asyncio
 async def test_reject_cyclic():
@@ -128,42 +149,80 @@ async def test_reject_cyclic():
             }
         )
 
-        results = await C.run("0")
-        print(results)
+        await C.run("0")
 
 @pytest.mark.asyncio
-async def test_wait_sync():
+async def test_reject_cyclic_rollback():
 
     C = Coordinator()
 
-    C += Step(
-        name="ts", 
-        func=f_str_to_int, 
-        depends_on={"_source": "msg"}
-    )
+    C += Step(name="t0", func=f_str_to_int, depends_on={"_source": "msg"})
+    C += Step(name="t1", func=f_int_to_int, depends_on={"t0": "msg"})
 
-    C += {
-        'name': "rq", 
-        'func': f_sync_http,
-        'depends_on': {
-            "ts": "msg",
-        }
-    }
+    with pytest.raises(ValueError) as err:
+        C += Step(name="t0x", func=f_int_to_int, depends_on={"t1": "msg", "t0x": None})
 
-    C += {
-        'name': "ti", 
-        'func': f_int_to_int,
-        'depends_on': {
-            "ts": "msg",
-            "rq": None,
-        }
-    }
+    assert "t0x" not in C
+    assert "t0x" not in C.dag()
 
     results = await C.run("0")
-    print(results)
+    assert results == {"t1": 0}
+
+@pytest.fixture(autouse=True)
+def mock_http():
+    """ serve requests' HTTP calls in process (see aio_session for aiohttp) """
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(responses.GET, "http://google.com", body="", status=200)
+        yield rsps
+
+async def empty_response(request: web.Request) -> web.Response:
+    return web.Response(text="")
+
+class LocalResolver(AbstractResolver):
+    """ resolve every host to a local (test) server's port """
+
+    def __init__(self, port: int):
+        self.port = port
+
+    async def resolve(self, host: str, port: int=0, family: int=socket.AF_INET):
+        return [{
+            'hostname': host, 'host': "127.0.0.1", 'port': self.port, 
+            'family': socket.AF_INET, 'proto': 0, 'flags': socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self) -> None:
+        pass
+
+@pytest.fixture(scope="session", autouse=True)
+def http_session():
+    """ close the shared requests session after all the tests """
+    yield _HTTP
+    _HTTP.close()
+
+@pytest_asyncio.fixture(scope="session")
+async def aio_session():
+    """ one aiohttp session (connection pool) for all the tests
+
+    Every host resolves to an in-process server, so the HTTP calls go
+    through aiohttp's real transport without leaving the machine. 
+    """
+    global _SESSION
+    app = web.Application()
+    app.router.add_get("/", empty_response)
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    _SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100, ttl_dns_cache=300, keepalive_timeout=75,
+            resolver=LocalResolver(server.port), 
+        )
+    )
+    yield _SESSION
+    await _SESSION.close()
+    await server.close()
+    _SESSION = None
 
-@pytest.mark.asyncio
-async def test_wait_async():
+def make_wait_dag(name: str, func: Any, **options) -> Coordinator:
 
     C = Coordinator()
 
@@ -174,11 +233,12 @@ async def test_wait_async():
     )
 
     C += {
-        'name': "aq", 
-        'func': f_aio_http,
+        'name': name, 
+        'func': func,
         'depends_on': {
             "ts": "msg",
-        }
+        },
+        **options, 
     }
 
     C += {
@@ -186,74 +246,40 @@ async def test_wait_async():
         'func': f_int_to_int,
         'depends_on': {
             "ts": "msg",
-            "aq": None,
+            name: None,
         }
     }
 
-    results = await C.run("0")
-    print(results)
-
-@pytest.mark.asyncio
-async def test_wait_sync_call():
-
-    C = Coordinator()
-
-    C += Step(
-        name="ts", 
-        func=f_str_to_int, 
-        depends_on={"_source": "msg"}
-    )
-
-    C += {
-        'name': "rq", 
-        'func': f_sync_http,
-        'depends_on': {
-            "ts": "msg",
-        }
-    }
+    return C
 
-    C += {
-        'name': "ti", 
-        'func': f_int_to_int,
-        'depends_on': {
-            "ts": "msg",
-            "rq": None,
-        }
+@pytest.fixture(scope="session")
+def wait_coords() -> Dict[str,Coordinator]:
+    """ the wait step graphs, sync and async, built once """
+    return {
+        "sync": make_wait_dag("rq", f_sync_http, threaded=True), 
+        "async": make_wait_dag("aq", f_aio_http), 
     }
 
-    results = await C("0")
-    print(results)
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["sync", "async"])
+@pytest.mark.parametrize("invoke", ["run", "call"])
+async def test_wait(aio_session, wait_coords, kind, invoke):
+    C = wait_coords[kind]
+    results = await (C.run("0") if invoke == "run" else C("0"))
+    assert results == {"ti": 0}
 
 @pytest.mark.asyncio
-async def test_wait_async_call():
+async def test_threaded():
 
     C = Coordinator()
 
-    C += Step(
-        name="ts", 
-        func=f_str_to_int, 
-        depends_on={"_source": "msg"}
-    )
-
-    C += {
-        'name': "aq", 
-        'func': f_aio_http,
-        'depends_on': {
-            "ts": "msg",
-        }
-    }
-
-    C += {
-        'name': "ti", 
-        'func': f_int_to_int,
-        'depends_on': {
-            "ts": "msg",
-            "aq": None,
-        }
-    }
+    C += Step(name="w1", func=f_sync_wait, depends_on={"_source": "w"}, threaded=True)
+    C += Step(name="w2", func=f_sync_wait, depends_on={"_source": "w"}, threaded=True)
 
-    results = await C("0")
-    print(results)
+    s = time()
+    results = await C.run(0.2)
+    assert results == {"w1": 0.2, "w2": 0.2}
+    assert time() - s < 0.35 # the waits overlap
 
 @pytest.mark.asyncio
 async def test_fail_incomplete():
@@ -279,6 +305,23 @@ async def test_fail_incomplete():
 
         results = await C.run("0")
 
+@pytest.mark.asyncio
+async def test_fail_incomplete_cached():
+
+    C = Coordinator()
+
+    C += Step(name="ts", func=f_str_to_int, depends_on={"_source": "msg"})
+    C += Step(name="ti", func=f_int_to_int, depends_on={"ts": "msg", "rq": None})
+
+    # the cached sets can't be changed by callers, so verify still sees "rq"
+    with pytest.raises(AttributeError):
+        C.intermediates().discard("rq")
+    with pytest.raises(AttributeError):
+        C.leaves().add("rq")
+
+    with pytest.raises(ValueError) as err:
+        results = await C.run("0")
+
 @pytest.mark.asyncio
 async def test_params():
 
@@ -299,7 +342,7 @@ async def test_params():
     }
 
     results = await C.run("0", params={'a': 0})
-    print(results)
+    assert results == {"ti": 0}
 
 @pytest.mark.asyncio
 async def test_fail():
@@ -321,22 +364,65 @@ async def test_fail():
             }
         }
 
+        await C.run("0", params={'ts': 0})
+
+@pytest.mark.asyncio
+async def test_fail_reverify():
+
+    C = Coordinator()
+
+    C += Step(
+        name="ts", 
+        func=f_str_to_int, 
+        depends_on={"_source": "msg"}
+    )
+
+    results = await C.run("0", params={'a': 0})
+    P = C.plan()
+
+    # new param keys re-run the ambiguity check, but reuse the plan
+    results = await C.run("0", params={'b': 0})
+    assert C.plan() is P
+
+    with pytest.raises(ValueError) as err:
         results = await C.run("0", params={'ts': 0})
-        print(results)
+
+    # changing the steps rebuilds the plan
+    C += Step(name="ti", func=f_int_to_int, depends_on={"ts": "msg"})
+    results = await C.run("0", params={'b': 0})
+    assert C.plan() is not P and results == {"ti": 0}
 
 
 class Yielder(Source):
 
-    def __init__(self, t):
-        self.t = t
+    def __init__(self, n: int=10, delay: float=0):
+        self.n = n
+        self.delay = delay
 
     async def __call__(self):
-        for i in range(10):
+        for i in range(self.n):
             yield i
-            await asyncio.sleep(self.t)
+            await asyncio.sleep(self.delay)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("n", [10, 1000])
+async def test_gen(n):
+
+    C = Coordinator()
+
+    C += Step(
+        name="ta", 
+        func=f_add, 
+        depends_on={
+            "_source": "i"
+        }
+    )
+
+    results = [r async for r in C.poll(Yielder(n=n))]
+    assert results == [{"ta": i + 1} for i in range(n)]
 
 @pytest.mark.asyncio
-async def test_gen():
+async def test_gen_overlap():
 
     C = Coordinator()
 
@@ -348,10 +434,50 @@ async def test_gen():
         }
     )
 
-    async for results in C.poll(Yielder(0.1)):
-        print(await results)
+    results = [r async for r in C.poll(Yielder(n=10), overlap=4)]
+    assert sorted(r['ta'] for r in results) == list(range(1, 11))
 
 
+@pytest.mark.asyncio
+async def test_gen_overlap_fail():
+
+    calls = []
+
+    async def f_fail_or_wait(i: int) -> int:
+        await asyncio.sleep(0.01 if i == 0 else 0.1)
+        if i == 0:
+            raise ValueError("first run fails")
+        calls.append(i)
+        return i
+
+    C = Coordinator()
+
+    C += Step(name="tf", func=f_fail_or_wait, depends_on={"_source": "i"})
+
+    # the first run fails while the second is in flight
+    with pytest.raises(ValueError) as err:
+        async for results in C.poll(Yielder(n=2), overlap=2):
+            pass
+
+    # the consumer stops early, with runs in flight
+    async def f_first_or_wait(i: int) -> int:
+        if i > 0:
+            await asyncio.sleep(0.1)
+            calls.append(i)
+        return i
+
+    D = Coordinator()
+
+    D += Step(name="tw", func=f_first_or_wait, depends_on={"_source": "i"})
+
+    gen = D.poll(Yielder(n=10), overlap=4)
+    assert await gen.__anext__() == {"tw": 0}
+    await gen.aclose()
+
+    # no run is left executing steps once poll is done
+    await asyncio.sleep(0.2)
+    assert calls == []
+
 @pytest.mark.asyncio
 async def test_multiple():
 
@@ -379,3 +505,298 @@ async def test_multiple():
     # running concurrently should take around 2 seconds, not the 
     # total "wait" time of 3 seconds
     assert d < 3
+
+@pytest.mark.asyncio
+async def test_no_dependencies():
+
+    C = Coordinator()
+
+    C += Step(name="t", func=f_str_to_int, depends_on={"_source": "msg"})
+    C += Step(name="solo", func=f_noargs)
+
+    assert "solo" in C.dag()
+    results = await C.run("0")
+    assert results == {"t": 0, "solo": 1}
+
+    C.add_many([Step(name="solo2", func=f_noargs)])
+    results = await C.run("0")
+    assert results == {"t": 0, "solo": 1, "solo2": 1}
+
+    with pytest.raises(ValueError) as err:
+        C.add_many([
+            Step(name="solo3", func=f_noargs),
+            Step(name="u0", func=f_int_to_int, depends_on={"t": "msg", "u1": None}),
+            Step(name="u1", func=f_int_to_int, depends_on={"u0": "msg"}),
+        ])
+
+    assert "solo3" not in C and "solo3" not in C.dag()
+
+@pytest.mark.asyncio
+async def test_diamond():
+
+    C = Coordinator()
+
+    C += Step(name="a", func=f_aio_pass, depends_on={"_source": "x"})
+    C += Step(name="b", func=f_aio_pass, depends_on={"_source": "x"})
+    C += Step(name="join", func=f_aio_join, depends_on={"a": "a", "b": "b"})
+
+    s = perf_counter()
+    results = await C.run(1)
+    d = perf_counter() - s
+
+    assert results == {"join": 2}
+
+    # a and b run side by side, so this takes two (0.1s) waits, the 
+    # depth of the graph, not three (the number of steps)
+    assert d < 0.25
+
+@pytest.mark.asyncio
+async def test_cache():
+
+    calls = []
+
+    def f_count(i: int) -> int:
+        calls.append(i)
+        return i
+
+    C = Coordinator()
+
+    C += Step(
+        name="tc", 
+        func=f_count, 
+        depends_on={"_source": "i"},
+        cache=2,
+    )
+
+    for i in [0, 1, 0, 2, 0, 1]:
+        results = await C.run(i)
+        assert results == {"tc": i}
+
+    # 0 and 1 were cached, 2 evicted 1, and 0 stayed most recently used
+    assert calls == [0, 1, 2, 1]
+
+    # arguments are validated before the cache is checked (1.0 == 1)
+    with pytest.raises(ValueError) as err:
+        await C.run(1.0)
+
+    with pytest.raises(ValueError) as err:
+        Step(name="tc", func=f_count, depends_on={"_source": "i"}, cache=-1)
+
+@pytest.mark.asyncio
+async def test_missing_argument():
+
+    def f_two(i: int, j: int) -> int:
+        return i + j
+
+    C = Coordinator()
+
+    C += Step(
+        name="tt", 
+        func=f_two, 
+        depends_on={"_source": "i"}
+    )
+
+    with pytest.raises(ValueError) as err:
+        results = await C.run(0)
+
+    results = await C.run(0, params={'j': 1})
+    assert results == {"tt": 1}
+
+@pytest.mark.asyncio
+async def test_subclass_types():
+
+    class Msg(str):
+        pass
+
+    def f_any(x: Any, y: List[int]) -> int:
+        return len(y)
+
+    C = Coordinator()
+
+    C += Step(
+        name="ts", 
+        func=f_str_to_int, 
+        depends_on={"_source": "msg"}
+    )
+
+    C += Step(
+        name="ta", 
+        func=f_any, 
+        depends_on={"ts": "x"}
+    )
+
+    results = await C.run(Msg("0"), params={'y': [1, 2]})
+    assert results == {"ta": 2}
+
+    with pytest.raises(ValueError) as err:
+        results = await C.run(Msg("0"), params={'y': (1, 2)})
+
+def test_step_namespace():
+
+    C = Coordinator()
+
+    C += Step(
+        name="ts", 
+        func=f_str_to_int, 
+        depends_on={"_source": "msg"}
+    )
+
+    assert C.step.ts.func is f_str_to_int
+    assert C.step is C.step
+
+    C += Step(
+        name="ti", 
+        func=f_int_to_int, 
+        depends_on={"ts": "msg"}
+    )
+
+    assert C.step.ti.func is f_int_to_int
+
+    C -= "ts"
+    assert not hasattr(C.step, "ts")
+
+def test_step_hash():
+
+    s = Step(name="ts", func=f_str_to_int, depends_on={"_source": "msg"})
+    t = Step(name="ts", func=f_int_to_int, depends_on={"_source": "msg"})
+    u = Step(name="tu", func=f_str_to_int, depends_on={"_source": "msg"})
+
+    assert isinstance(hash(s), int)
+    assert s == t and s != u and s != "ts"
+    assert {s, t, u} == {s, u}
+
+@pytest.mark.asyncio
+async def test_step_immutable():
+
+    s = Step(name="ts", func=f_str_to_int, depends_on={"_source": "msg"})
+
+    with pytest.raises(ValueError) as err:
+        s.func = f_aio_add
+
+    # copies recompute what's derived from the fields
+    t = s.model_copy(update={"func": f_aio_add, "depends_on": {"_source": "i"}})
+    assert t.is_async() and not s.is_async()
+
+    C = Coordinator()
+    C += t
+    results = await C.run(1)
+    assert results == {"ts": 2}
+
+@pytest.mark.asyncio
+async def test_launch():
+
+    C = Coordinator()
+
+    C += Step(
+        name="ts", 
+        func=f_str_to_int, 
+        depends_on={"_source": "msg"}
+    )
+
+    C += Step(
+        name="ti", 
+        func=f_int_to_int, 
+        depends_on={"ts": "msg"}
+    )
+
+    assert await C.launch("ts", source="1", data={}, params={}) == 1
+    assert C.launch("ti", source="1", data={}, params={}) is None
+    assert await C.launch(C.step.ti, source="1", data={"ts": 2}, params={}) == 2
+
+    # sync steps are called inline, so the future is already resolved
+    # (with the result or the executor's error) rather than a Task
+    F = C.launch("ts", source="1", data={}, params={})
+    assert F.done() and not isinstance(F, asyncio.Task) and F.result() == 1
+    F = C.launch("ts", source="x", data={}, params={})
+    assert F.done() and isinstance(F.exception(), ValueError)
+
+    with pytest.raises(ValueError) as err:
+        C.launch("tx", source="1", data={}, params={})
+
+@pytest.mark.asyncio
+async def test_add_many():
+
+    C = Coordinator()
+
+    C.add_many([
+        {
+            'name': f"t{i}", 
+            'func': f_add,
+            'depends_on': {"_source" if i == 0 else f"t{i-1}": "i"}
+        } for i in range(5)
+    ])
+
+    results = await C.run(0)
+    assert results == {"t4": 5}
+
+    with pytest.raises(ValueError) as err:
+        C.add_many([
+            Step(name="u0", func=f_int_to_int, depends_on={"t4": "msg", "u1": None}),
+            Step(name="u1", func=f_int_to_int, depends_on={"u0": "msg"}),
+        ])
+
+    assert "u0" not in C and "u1" not in C
+    assert "u0" not in C.dag() and "u1" not in C.dag()
+
+    with pytest.raises(ValueError) as err:
+        C.add_many([Step(name="u0", func=f_int_to_int, depends_on={"t4": "msg"}), "t5"])
+
+    assert "u0" not in C
+
+    results = await C.run(0)
+    assert results == {"t4": 5}
+
+@pytest.mark.asyncio
+async def test_plan():
+
+    C = Coordinator()
+
+    C += Step(name="ts", func=f_str_to_int, depends_on={"_source": "msg"})
+    C += Step(name="ta", func=f_int_to_int, depends_on={"ts": "msg"})
+    C += Step(name="tb", func=f_add, depends_on={"ts": "i"})
+    C += Step(name="tc", func=f_add, depends_on={"ta": "i", "tb": None})
+
+    assert C.plan() is None
+    C.verify(params={})
+
+    P = C.plan()
+    assert len(P) == 4
+    assert P.topo[0] == "ts" and P.topo[-1] == "tc"
+    assert [P.index[s] for s in P.topo] == [0, 1, 2, 3]
+    assert [s.name for s in P.steps] == P.topo
+    ts, ta, tb, tc = (P.index[s] for s in ("ts", "ta", "tb", "tc"))
+    assert P.initial == (ts,)
+    assert [P.deps_ct[i] for i in (ts, ta, tb, tc)] == [0, 1, 1, 2]
+    assert sorted(P.children[ts]) == sorted([ta, tb])
+    assert P.leaves == (tc,)
+    data = [None] * 4
+    data[ta], data[tb] = 1, 2
+    assert P.kwarg_builders[tc]("1", data, {}) == {"i": 1, "_params": {}}
+
+    results = await C.run("1")
+    assert results == {"tc": 2}
+
+@pytest.fixture(scope="session")
+def wide_coord() -> Coordinator:
+    """ source -> 100 (async) steps -> join """
+    C = Coordinator()
+    C.extend(
+        Step(name=f"w{i}", func=f_aio_add, depends_on={"_source": "i"}) 
+        for i in range(100)
+    )
+    C += Step(
+        name="join", 
+        func=f_add, 
+        depends_on={"_source": "i", **{f"w{i}": None for i in range(100)}}
+    )
+    return C
+
+def test_scheduler_throughput(benchmark, wide_coord):
+    # compare runs with eg --benchmark-autosave, --benchmark-compare 
+    # and --benchmark-compare-fail=mean:20%
+    loop = asyncio.new_event_loop() # one (warm) loop for all rounds
+    try:
+        results = benchmark(lambda: loop.run_until_complete(wide_coord.run(0)))
+    finally:
+        loop.close()
+    assert results == {"join": 1}
@@ -1,76 +1,177 @@
 
+import logging
+import pytest
+
+from typing import Any, Dict, Tuple
+
 from coordinator import Graph
 
+log = logging.getLogger(__name__)
+
+def closure(g: Graph) -> Tuple[Dict[Any,int],Dict[Any,int]]:
+    """ brute force: transitive closure of g (Warshall's algorithm)
+
+    Each node's row of the reachability matrix is an int, used as a 
+    bitset: m is reachable from n if bit idx[m] of reach[n] is set. 
+    So adding all paths through k to n's row is a single "or". 
+
+    Returns (idx, reach)
+    """
+    idx = {n: i for i, n in enumerate(g.nodes())}
+    reach = dict.fromkeys(idx, 0)
+    for u, v in g.edges():
+        reach[u] |= 1 << idx[v]
+    for k, i in idx.items():
+        for n in reach:
+            if reach[n] >> i & 1:
+                reach[n] |= reach[k]
+    return idx, reach
+
+def has_cycle(g: Graph) -> bool:
+    """ brute force: can any node reach itself? """
+    idx, reach = closure(g)
+    return any(reach[n] >> i & 1 for n, i in idx.items())
+
 def run_tests(g: Graph) -> None:
     """ Not really tests tests
 
-    Print the group and it's SCCs (and whether cyclic)
+    Log the group and it's SCCs (and whether cyclic)
     Then enumerate all paths and assert some basic properties
     of them: they start and end correctly, and any pair in the
     path is in fact an edge
     """
-    print( g.nodes() , "->" , ', '.join([f"{l}" for l in g.scc()]) , f"({g.cyclic()})" )
-    for n in g.nodes():
-        for m in [m for m in g.nodes() if m != n]:
+    cyclic, nodes = g.cyclic(), list(g.nodes())
+    assert cyclic == has_cycle(g) == g.has_cycle()
+    assert g.roots() == {n for n in nodes if not any(v == n for _, v in g.edges())}
+    log.debug("%s -> %s (%s)", nodes, g.scc(), cyclic)
+    idx, reach = closure(g)
+    for i, n in enumerate(nodes):
+        for j, m in enumerate(nodes):
+            if i == j:
+                continue
             p = g.path(n,m)
+            assert (p is not None) == bool(reach[n] >> idx[m] & 1)
             if p is not None:
                 assert p[0] == n
                 assert p[-1] == m
-                for i in range(1,len(p)):
-                    assert g.is_edge(p[i-1], p[i])
-                print(" ", n, "->", m, ":", ' -> '.join([f"{v}" for v in p]))
+                for k in range(1,len(p)):
+                    assert g.is_edge(p[k-1], p[k])
+                log.debug("  %s -> %s : %s", n, m, p)
+    t, l = g.topological(), g.levels()
+    if cyclic:
+        assert t is None and l is None
+    else:
+        assert set(t) == g.nodes()
+        for u, v in g.edges():
+            assert t.index(u) < t.index(v)
+        level = {u: i for i, lvl in enumerate(l) for u in lvl}
+        assert set(level) == g.nodes() and sum(map(len, l)) == len(level)
+        for v in nodes:
+            preds = [level[u] for u, w in g.edges() if w == v]
+            assert level[v] == (max(preds) + 1 if preds else 0)
 
-def test_1():
-    g = Graph().add(1, 0).add(0, 2).add(2, 1).add(0, 3).add(3, 4)
-    run_tests(g)
-    run_tests(g.reverse())
+GRAPHS = [
+    [(1,0),(0,2),(2,1),(0,3),(3,4)],
+    [(0,1),(1,2),(2,3)],
+    [(0,1),(1,2),(2,0),(1,3),(1,4),(1,6),(3,5),(4,5)],
+    [
+        (0,1),(0,3),(1,2),(1,4),(2,0),(2,6),(3,2),(4,5),(4,6),
+        (5,6),(5,7),(5,8),(5,9),(6,4),(7,9),(8,9),(9,8),
+    ],
+    [(0,1),(1,2),(2,3),(2,4),(3,0),(4,2)],
+    [(0,1),(0,2),(1,3),(2,3),(3,4)],
+]
 
-def test_2():
-    g = Graph(edges=[(1,0),(0,2),(2,1),(0,3),(3,4)])
-    run_tests(g)
-    run_tests(g.reverse())
+@pytest.mark.parametrize("reverse", [False, True], ids=["forward", "reverse"])
+@pytest.mark.parametrize("build", ["add", "init"])
+@pytest.mark.parametrize("edges", GRAPHS, ids=[f"g{i}" for i in range(len(GRAPHS))])
+def test_graph(edges, build, reverse):
+    if build == "add": # incrementally
+        g = Graph()
+        for u, v in edges:
+            g.add(u, v)
+    else:
+        g = Graph(edges=edges)
+    run_tests(g.reverse() if reverse else g)
 
-def test_3():
-    g = Graph().add(0, 1).add(1, 2).add(2, 3)
-    run_tests(g)
-    run_tests(g.reverse())
+def test_incremental_cycles():
+    from random import Random
+    rng = Random(0)
+    for _ in range(20):
+        g = Graph()
+        for _ in range(30):
+            u, v = rng.randrange(12), rng.randrange(12)
+            g.add(u, v)
+            assert g.cyclic() == has_cycle(g) == g.has_cycle()
+        for u, v in list(g.edges()):
+            g.remove(u, v)
+            assert g.cyclic() == has_cycle(g) == g.has_cycle()
 
-def test_4():
-    g = Graph()
-    g.add(0, 1)
-    g.add(1, 2)
-    g.add(2, 0)
-    g.add(1, 3)
-    g.add(1, 4)
-    g.add(1, 6)
-    g.add(3, 5)
-    g.add(4, 5)
+def test_add_edges():
+    g = Graph().add_edges([(0,1),(1,2),(2,3),(2,4)])
+    assert g.acyclic()
+    g.add(4, 0)
+    assert g.cyclic()
+    g.remove(4, 0)
+    assert g.acyclic()
+    g.add_edges([(3,1)])
+    assert g.cyclic()
     run_tests(g)
     run_tests(g.reverse())
 
-def test_5():
-    g = Graph()
-    g.add(0, 1)
-    g.add(0, 3)
-    g.add(1, 2)
-    g.add(1, 4)
-    g.add(2, 0)
-    g.add(2, 6)
-    g.add(3, 2)
-    g.add(4, 5)
-    g.add(4, 6)
-    g.add(5, 6)
-    g.add(5, 7)
-    g.add(5, 8)
-    g.add(5, 9)
-    g.add(6, 4)
-    g.add(7, 9)
-    g.add(8, 9)
-    g.add(9, 8)
+def test_bulk_load():
+    edges, nodes = [(0,1),(1,2),(0,1),(2,3)], [5,2,6]
+    g, h = Graph(nodes=nodes, edges=edges), Graph()
+    for u, v in edges:
+        h.add(u, v)
+    for v in nodes:
+        h.add(v)
+    assert repr(g) == repr(h) and g.scc() == h.scc()
+    g.scc()
+    g.bulk_load(edges=[(3,0)])
+    assert g.cyclic() and g.is_edge(3, 0)
     run_tests(g)
-    run_tests(g.reverse())
+    h = Graph(edges=[(1,None),(None,2)], nodes=[None,3]) # as add does
+    assert repr(h) == repr(Graph().add(1, None).add(None, 2).add(None).add(3))
+    assert h.nodes() == {1, 3} and not h.edges()
 
-def test_6():
-    g = Graph(edges=[(0,1),(1,2),(2,3),(2,4),(3,0),(4,2)])
-    run_tests(g)
-    run_tests(g.reverse())
+def test_deep_scc():
+    n = 5000 # deeper than the default recursion limit
+    g = Graph(edges=[(i, i+1) for i in range(n)])
+    assert len(g.scc()) == n + 1
+    g.add(n, 0)
+    assert g.scc() == [list(range(n, -1, -1))]
+
+def test_scc_dag():
+    g = Graph(edges=[(1,0),(0,2),(2,1),(0,3),(3,4),(4,3),(1,5)])
+    comps, adj = g.scc_dag()
+    assert comps == g.scc()
+    comp = {u: i for i, c in enumerate(comps) for u in c}
+    assert sorted(map(sorted, comps)) == [[0,1,2],[3,4],[5]]
+    assert adj[comp[0]] == {comp[3], comp[5]}
+    assert not adj[comp[3]] and not adj[comp[5]]
+
+def test_repeated_edges():
+    g = Graph(edges=[(0,1),(0,1),(1,2)])
+    assert g.edges() == {(0,1),(1,2)}
+    g.remove(0, 1)
+    assert not g.is_edge(0, 1) and g.edges() == {(1,2)}
+    assert g.roots() == {0, 1}
+    g.add(2, 2)
+    assert g.cyclic()
+    assert g.edges() == {(1,2),(2,2)}
+    g.remove(2)
+    assert g.acyclic() and g.nodes() == {0, 1} and not g.edges()
+
+def test_path():
+    g = Graph(edges=[(0,1),(1,2),(2,3),(0,4),(4,3),(3,0),(5,5)])
+    assert g.path(0, 3) == [0, 4, 3]
+    assert g.path(3, 3) == [3, 0, 4, 3]
+    assert g.path(5, 5) == [5, 5]
+    assert g.path(0, 5) is None
+    assert g.path(0, 6) is None
+    g.add(4, 5)
+    assert g.path(0, 5) == [0, 4, 5]
+    g.remove(4)
+    assert g.path(0, 5) is None
+    assert g.path(0, 3) == [0, 1, 2, 3]